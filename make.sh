@@ -22,3 +22,12 @@ then
 		  -ldl -lm -o $(basename $TEST .c);
     done
 fi
+
+if [ ! -z "$BUILD_PARSER" ];
+then
+    BUILD=$(mktemp -d)
+    cp "$BASE/scripts/poireau.py" "$BUILD/"
+    (cd "$BUILD" && ${MYPYC:-mypyc} poireau.py) && \
+	cp "$BUILD"/poireau.*.so "$BASE/scripts/"
+    rm -rf "$BUILD"
+fi
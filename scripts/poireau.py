@@ -27,6 +27,10 @@ work is in generating backtraces, not printing events: a pair of
 `time` runs with and without dwarf stacktrace shows that walking and
 symbolicating the stack is >95% of `perf trace`'s CPU time.
 
+The parser is annotated so that `mypyc poireau.py` compiles the module
+to a C extension with the same behaviour, for when the script itself
+can't keep up with perf.
+
 perf trace's output is a series of records of the form
 
  17602.282 coronerd/0/15464 sdt_libpoireau:malloc(__probe_ip: 140369085100327, arg1: 362, arg2: 139998753980416, arg3: 22605)
@@ -58,19 +62,63 @@ We can thus run a command under `perf record`, e.g.,
 
 `perf record -T -e sdt_libpoireau:* --call-graph=dwarf -- ./profilee`,
 
-and analyse offline with `perf script | ./poireau.py`.
+and analyse offline with `perf script | ./poireau.py`.  Asking
+`perf script` for a fixed list of fields lets us skip the event
+patterns altogether:
+
+`perf script -F comm,tid,time,event,trace,ip,sym,dso | ./poireau.py --field-mode`
 """
-from collections import defaultdict, namedtuple
+from array import array
+from collections import namedtuple
 from datetime import datetime
-import fileinput
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Pattern,
+    Tuple,
+)
+import codecs
+import fcntl
+import functools
+import heapq
+import logging
 import os
+import queue
 import re
 import sys
 import signal
+import threading
 import time
 
 # SPDX-License-Identifier: MIT
 
+# `BUILD_PARSER=1 ./make.sh` compiles this module with mypyc, next to
+# the script.  When that compiled module is at least as recent as the
+# script, hand over to it before we even parse the command line.
+if __name__ == "__main__":
+    import importlib
+    import importlib.util
+
+    COMPILED_SPEC = importlib.util.find_spec("poireau")
+    if (
+        COMPILED_SPEC is not None
+        and COMPILED_SPEC.origin is not None
+        and not COMPILED_SPEC.origin.endswith(".py")
+        and os.path.getmtime(COMPILED_SPEC.origin) >= os.path.getmtime(__file__)
+    ):
+        importlib.import_module("poireau").main()
+
+# Are we reading the fixed field list of `perf script -F`?  See
+# parse_field_event.
+FIELD_MODE = "--field-mode" in sys.argv[1:]
+if FIELD_MODE:
+    sys.argv.remove("--field-mode")
+
 # Do we want to track sampled allocs when we hit the max heap footprint?
 TRACK_HIGH_WATER_MARK = False
 
@@ -94,20 +142,44 @@ RECORDS_MATCH_REAL_TIME = len(sys.argv) <= 1 or sys.argv[1] == "-"
 # default sampling period (32 MB).
 ALLOCATION_SAMPLING_BYTE_PERIOD = os.environ.get("POIREAU_SAMPLE_PERIOD_BYTES", 32 << 20)
 
-# Only track events with a comm (executable) that matches this pattern.
-COMM_PATTERN = re.compile(".*")
+# Reports only print that many allocations: the largest ones at the
+# high water mark, and the oldest ones in periodic reports.  SIGHUP and
+# the final report on shutdown still print every live allocation.
+REPORT_LIMIT = int(os.environ.get("POIREAU_REPORT_LIMIT", 1000))
+
+# Only track events with a comm (executable) that matches this pattern,
+# e.g., re.compile("coronerd").  None tracks everything, without
+# checking each event's comm.
+COMM_PATTERN: Optional[Pattern[str]] = None
+
+
+# Periodically log progress, at most once per that many seconds.
+LOG_PERIOD = 1.0 if RECORDS_MATCH_REAL_TIME else None
 
+# Only check the clock for LOG_PERIOD once per that many events.
+LOG_ROW_PERIOD = 100
 
-# Periodically log when we process a parsable row.
-LOG_ROW_PERIOD = 100 if RECORDS_MATCH_REAL_TIME else None
+# Diagnostics go to stderr, through this logger.  Progress lines are
+# logged at INFO, and anomalies in the trace at WARNING.
+LOG_LEVEL = os.environ.get("POIREAU_LOG_LEVEL", "INFO")
+
+logger = logging.getLogger("poireau")
 
 
 ## Ingestion end of the pipeline: parse a stream of lines into a stream of Event tuples.
 Frame = namedtuple("Frame", ["symbol", "dso"])
 
+# Once segment_trace has seen its frames, an event's stack is an index
+# in STACK_POOL.
 Event = namedtuple("Event", ["ts", "comm", "tid", "call", "stack"])
 
 
+# These patterns stick to the stdlib re module.  Lines are short, so
+# per-call overhead dominates matching time, and google-re2's DFA is
+# 5-10x slower than re on these patterns once we go through its Python
+# binding.  Avoid running regexes at all instead (see split_event and
+# split_frame): the patterns only see unusual lines, and define what
+# the fast paths must accept, so keep them simple rather than fast.
 EVENT_PATTERN = re.compile(
     r"^\s*([0-9]+\.[0-9]*) (.*)/([0-9]+) (.*:.*[(].*[)])$", flags=re.ASCII
 )
@@ -120,12 +192,129 @@ NEW_EVENT_PATTERN = re.compile(
 
 # coronerd/38 31909 [009] 627769.713769:               sdt_libpoireau:malloc: (7f4d353bd14d) arg1=8493 arg2=14291503677440 arg3=436
 SCRIPT_EVENT_PATTERN = re.compile(
-    r"^\s*(.*/[0-9]+) ([0-9]+) [[][0-9]+[]] ([0-9]+.[0-9]+):\s*(.*:.*):\s*\(([0-9a-f]+)\) ((arg[1-9][0-9]*=.+)*)$",
+    r"^\s*(.*/[0-9]+) ([0-9]+) \[[0-9]+\] ([0-9]+.[0-9]+):\s*(.*:.*):\s*\(([0-9a-f]+)\) ((arg[1-9][0-9]*=.+)*)$",
     flags=re.ASCII,
 )
 
 
-def parse_event(line):
+# Event lines always include the probe name; stack frames never do.
+EVENT_MARKER = "sdt_libpoireau:"
+
+# Characters matched by \s in ASCII regexes.
+ASCII_WHITESPACE = " \t\n\r\f\v"
+
+DECIMAL_DIGITS = frozenset("0123456789")
+
+HEX_DIGITS = frozenset("0123456789abcdef")
+
+# Maps the "(7f7951f584f6)" probe address of new format calls to the
+# "__probe_ip: 140159042815222" argument of the original format.  Each
+# probe site has a single address per process, so we only convert a
+# handful of them to decimal, instead of one per event.
+PROBE_IP_CACHE: Dict[str, str] = dict()
+
+PROBE_IP_CACHE_LIMIT = 1 << 12
+
+
+def split_new_call(name: str, rest: str) -> Optional[str]:
+    """Converts the '(7f7951f584f6) arg1=1 arg2=144' remainder of a
+    new format call to `name` back to the original format, like
+    parse_event does with NEW_EVENT_PATTERN.
+
+    Returns None for anything unusual.
+    """
+    ip, sep, argstr = rest.partition(") ")
+    if not sep or ":" in argstr:
+        return None
+    probe_ip = PROBE_IP_CACHE.get(ip)
+    if probe_ip is None:
+        if not ip.startswith("(") or len(ip) < 2 or not HEX_DIGITS.issuperset(ip[1:]):
+            return None
+        probe_ip = "__probe_ip: " + str(int(ip[1:], 16))
+        if len(PROBE_IP_CACHE) < PROBE_IP_CACHE_LIMIT:
+            PROBE_IP_CACHE[ip] = probe_ip
+    arg, sep, value = argstr.partition("=")
+    if (
+        not sep
+        or not value
+        or not arg.startswith("arg")
+        or arg[3:4] in ("", "0")
+        or not DECIMAL_DIGITS.issuperset(arg[3:])
+    ):
+        return None
+    args = [probe_ip]
+    args += [param.replace("=", ": ") for param in argstr.split()]
+    return name + "(" + ", ".join(args) + ")"
+
+
+def split_event(line: str) -> Optional[Event]:
+    """Splits the usual shapes of event lines (see parse_event) into an
+    Event tuple, without going through the event patterns.
+
+    Returns None for anything unusual (e.g., slashes in the call), in
+    which case the caller must fall back to the regexes.
+    """
+    start = line.find(EVENT_MARKER)
+    if start < 0 or "/" in line[start:]:
+        return None
+    head = line[:start]
+    call: Optional[str] = line[start:]
+    stripped_head = head.rstrip(ASCII_WHITESPACE)
+    if not stripped_head.endswith(":"):
+        # '  17605.033 coronerd/0/15464 sdt_libpoireau:malloc(...)' or
+        # '10332315.769 coronerd/110/12310 sdt_libpoireau:calloc:(7f7951f584f6) arg1=1'
+        ts, sep, comm_tid = head.lstrip(ASCII_WHITESPACE)[:-1].partition(" ")
+        if not sep or not head.endswith(" "):
+            return None
+        name, sep, rest = line[start:].rpartition(":(")
+        if sep and len(name) < len(EVENT_MARKER):
+            return None
+        if sep:
+            call = split_new_call(name, "(" + rest)
+        elif not line.endswith(")") or "(" not in line[start:]:
+            return None
+    else:
+        # 'coronerd/38 31909 [009] 627769.713769:    sdt_libpoireau:malloc: (7f4d353bd14d) arg1=8493'
+        fields = stripped_head[:-1].lstrip(ASCII_WHITESPACE).rsplit(" ", 3)
+        if len(fields) != 4:
+            return None
+        comm_tid, tid, cpu, ts = fields
+        thread = comm_tid.rpartition("/")[2]
+        if (
+            not thread
+            or not DECIMAL_DIGITS.issuperset(thread)
+            or not tid
+            or not DECIMAL_DIGITS.issuperset(tid)
+            or not cpu.startswith("[")
+            or not cpu.endswith("]")
+            or len(cpu) < 3
+            or not DECIMAL_DIGITS.issuperset(cpu[1:-1])
+            or ts.endswith(".")
+        ):
+            return None
+        comm_tid += "/" + tid
+        end = line.find(":", start + len(EVENT_MARKER))
+        if end < 0:
+            return None
+        rest = line[end + 1 :].lstrip(ASCII_WHITESPACE)
+        call = split_new_call(line[start:end], rest)
+    comm, sep, tid = comm_tid.rpartition("/")
+    int_part, dot, frac_part = ts.partition(".")
+    if (
+        call is None
+        or not sep
+        or not tid
+        or not DECIMAL_DIGITS.issuperset(tid)
+        or not dot
+        or not int_part
+        or not DECIMAL_DIGITS.issuperset(int_part)
+        or not DECIMAL_DIGITS.issuperset(frac_part)
+    ):
+        return None
+    return Event(float(ts) / 1000, sys.intern(comm), int(tid), call, None)
+
+
+def parse_event(line: str) -> Optional[Event]:
     """Expects a new event line line
     '  17605.033 coronerd/0/15464 sdt_libpoireau:malloc(__probe_ip: 140369085100327, arg1: 363, arg2: 139997680238592, arg3: 68076)'
     and returns an Event tuple populated with the timestamp, comm, tid,
@@ -133,35 +322,132 @@ def parse_event(line):
 
     The timestamp is converted to seconds.
     """
-    match = EVENT_PATTERN.fullmatch(line)
-    # New format... perf trace isn't exactly ABI stable.
-    if match is None:
-        match = NEW_EVENT_PATTERN.fullmatch(line)
-        if not match:
-            match = SCRIPT_EVENT_PATTERN.fullmatch(line)
-            if match:
-                line = f"{match[3]} {match[1]}/{match[2]} {match[4]}:({match[5]}) {match[6]}"
-                match = NEW_EVENT_PATTERN.fullmatch(line)
+    event = split_event(line)
+    if event is not None:
+        return event
+    # New format... perf trace isn't exactly ABI stable.  The original
+    # format is now rare, so we only try it last.
+    match = NEW_EVENT_PATTERN.fullmatch(line)
+    if not match:
+        match = SCRIPT_EVENT_PATTERN.fullmatch(line)
         if match:
-            args = ["__probe_ip=" + str(int(match[2], 16))] + match[3].split()
-            args = [param.replace("=", ": ") for param in args]
-            line = match[1] + "(" + ", ".join(args) + ")"
+            line = f"{match[3]} {match[1]}/{match[2]} {match[4]}:({match[5]}) {match[6]}"
+            match = NEW_EVENT_PATTERN.fullmatch(line)
+    if match:
+        args = ["__probe_ip=" + str(int(match[2], 16))] + match[3].split()
+        args = [param.replace("=", ": ") for param in args]
+        line = match[1] + "(" + ", ".join(args) + ")"
 
-            match = EVENT_PATTERN.fullmatch(line)
+    match = EVENT_PATTERN.fullmatch(line)
     if match is None:
-        print("Unhandled line: %s" % line, file=sys.stderr)
+        logger.warning("Unhandled line: %s", line)
         return None
-    return Event(float(match[1]) / 1000, match[2], int(match[3]), match[4], None)
+    return Event(
+        float(match[1]) / 1000, sys.intern(match[2]), int(match[3]), match[4], None
+    )
+
+
+def parse_field_event(line: str) -> Optional[Event]:
+    """Expects an event line from `perf script -F comm,tid,time,event,trace,ip,sym,dso`
+    like
+    '        coronerd 31909 627769.713769: sdt_libpoireau:malloc: (7f4d353bd14d) arg1=8493 arg2=14291503677440 arg3=436'
+    and returns an Event tuple like parse_event, with the call
+    rewritten to the original perf trace format.
+
+    The field list is fixed, so we can split the line on known
+    separators instead of matching it against the event patterns.
+    """
+    head, sep, trace = line.partition(EVENT_MARKER)
+    head = head.rstrip(ASCII_WHITESPACE)
+    if not sep or not head.endswith(":"):
+        logger.warning("Unhandled line: %s", line)
+        return None
+    # The comm may include spaces, but the tid and timestamp never do.
+    fields = head[:-1].rsplit(None, 2)
+    name, sep, trace = trace.partition(": ")
+    if len(fields) != 3 or not sep:
+        logger.warning("Unhandled line: %s", line)
+        return None
+    comm, tid, ts = fields
+    args = [tok.replace("=", ": ") for tok in trace.split() if tok.startswith("arg")]
+    try:
+        # perf script timestamps are already in seconds.
+        return Event(
+            float(ts),
+            sys.intern(comm.lstrip(ASCII_WHITESPACE)),
+            int(tid),
+            EVENT_MARKER + name + "(" + ", ".join(args) + ")",
+            None,
+        )
+    except ValueError:
+        logger.warning("Unhandled line: %s", line)
+        return None
+
+
+# Traces only have a few unique (symbol, dso) pairs, repeated across
+# millions of events.  Share one Frame tuple for each pair, so that
+# stacks in long-lived Allocation records don't keep their own copies.
+FRAME_CACHE: Dict[Tuple[str, str], Frame] = dict()
+
+# Each call site also prints the exact same frame line over and over,
+# so map raw frame lines to their Frame and skip parsing on repeats.
+# Addresses in frame lines make this cache grow with the number of
+# unique return addresses, so it stops growing at some point.
+FRAME_LINE_CACHE: Dict[str, Frame] = dict()
+
+FRAME_LINE_CACHE_LIMIT = 1 << 20
+
+# Likewise, a given call site tends to generate the same stack over and
+# over.  Events and allocation records refer to stacks by their index
+# in STACK_POOL, and STACK_IDS maps each stack tuple to that index, so
+# identical stacks share storage, and compare as small integers.
+STACK_IDS: Dict[Tuple[Frame, ...], int] = dict()
+
+STACK_POOL: List[Tuple[Frame, ...]] = []
 
 
 FRAME_PATTERN = re.compile(r"^\s*([^0-9.].*) [(](.*)[)]$", flags=re.ASCII)
 
 TRACE_FRAME_PATTERN = re.compile(
-    r"^\s*[0-9a-f]{4,}\s+([^0-9.].*?)(:?[+]0x[0-9a-f]+)? [(](.*)[)]$", flags=re.ASCII
+    r"^\s*[0-9a-f]{4,}\s+([^0-9.].*?)(?:[+]0x[0-9a-f]+)? [(](.*)[)]$", flags=re.ASCII
 )
 
 
-def parse_frame(line):
+def split_frame(line: str) -> Optional[Tuple[str, str]]:
+    """Splits the usual shapes of stack frame lines into a tuple of
+    symbol and path, without going through TRACE_FRAME_PATTERN or
+    FRAME_PATTERN.
+
+    Returns None for anything unusual (e.g., symbols with spaces), in
+    which case the caller must fall back to the regexes.
+    """
+    if not line.endswith(")"):
+        return None
+    stripped = line.lstrip(ASCII_WHITESPACE)
+    address, sep, rest = stripped.partition(" ")
+    if sep and len(address) >= 4 and HEX_DIGITS.issuperset(address):
+        # '7f4d353bd14d sampled_malloc+0x59 (/opt/backtrace/lib/libpoireau.so)'
+        rest = rest.lstrip(ASCII_WHITESPACE)
+        end = rest.find(" (")
+        if end <= 0 or rest[0] in "0123456789.":
+            return None
+        offset = rest.rfind("+0x", 0, end)
+        if 0 < offset < end - 3 and HEX_DIGITS.issuperset(rest[offset + 3 : end]):
+            return rest[:offset], rest[end + 2 : -1]
+        return rest[:end], rest[end + 2 : -1]
+    # '_crdb_column_open (/opt/backtrace/sbin/coronerd)'
+    symbol, sep, dso = stripped.rpartition(" (")
+    if (
+        not sep
+        or not symbol
+        or symbol[0] in "0123456789."
+        or any(char in symbol for char in ASCII_WHITESPACE)
+    ):
+        return None
+    return symbol, dso[:-1]
+
+
+def parse_frame(line: str) -> Optional[Frame]:
     """Expects a backtrace frame line like
     '                                       _crdb_column_open (/opt/backtrace/sbin/coronerd)'
     or
@@ -169,64 +455,226 @@ def parse_frame(line):
     and returns a tuple of the symbol and path, or none if the line
     does not look like a stack trace frame.
     """
-    match = TRACE_FRAME_PATTERN.fullmatch(line)
-    if match is None:
-        match = FRAME_PATTERN.fullmatch(line)
-    if match is None:
-        return None
-    return Frame(match[1], match[2])
+    frame = FRAME_LINE_CACHE.get(line)
+    if frame is not None:
+        return frame
+    symbol_dso = split_frame(line)
+    if symbol_dso is None:
+        match = TRACE_FRAME_PATTERN.fullmatch(line)
+        if match is None:
+            match = FRAME_PATTERN.fullmatch(line)
+        if match is None:
+            return None
+        symbol_dso = match[1], match[2]
+    key = (sys.intern(symbol_dso[0]), sys.intern(symbol_dso[1]))
+    frame = FRAME_CACHE.get(key)
+    if frame is None:
+        frame = FRAME_CACHE[key] = Frame(*key)
+    if len(FRAME_LINE_CACHE) < FRAME_LINE_CACHE_LIMIT:
+        FRAME_LINE_CACHE[line] = frame
+    return frame
+
+
+# Read traces in chunks of up to that many bytes.  read1() reads
+# directly into the chunk when it's larger than the stream's buffer.
+INPUT_BUFFER_SIZE = 1 << 20
+
+# The reader thread stays at most that many chunks ahead of the parser.
+# The parser is slower than read1(), so an unbounded queue would buffer
+# whole trace files in memory, and stop pushing back on perf's pipe.
+INPUT_QUEUE_CHUNKS = 4
+
+
+def grow_pipe_buffer(fd: int) -> None:
+    """Asks Linux for a pipe buffer of INPUT_BUFFER_SIZE bytes on `fd`.
+
+    The default 64 KB pipe buffer caps every read at 64 KB; a larger
+    one lets perf write ahead while we parse, and each read returns
+    more lines.  Does nothing when `fd` isn't a pipe, or when the
+    kernel refuses (e.g., above /proc/sys/fs/pipe-max-size).
+    """
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, INPUT_BUFFER_SIZE)
+    except (AttributeError, OSError):
+        pass
+
 
+def read_chunks(paths: List[str], chunks: "queue.Queue[Any]") -> None:
+    """Pushes raw chunks of bytes from each file in `paths` (stdin if
+    empty, or for "-") to the `chunks` queue, followed by None.
 
-def segment_trace(lines):
+    Runs in a reader thread, so that blocking reads overlap with parsing
+    on the main thread.  read1() returns whatever is already available,
+    so live traces aren't held back until a full buffer is ready.
+    `chunks` should be bounded: puts then block until the parser
+    catches up.
+    """
+    try:
+        for path in paths or ["-"]:
+            if path == "-":
+                stream = open(sys.stdin.fileno(), "rb", closefd=False)
+                grow_pipe_buffer(stream.fileno())
+            else:
+                stream = open(path, "rb")
+            with stream:
+                chunk = b""
+                while True:
+                    last = chunk
+                    chunk = stream.read1(INPUT_BUFFER_SIZE)
+                    if not chunk:
+                        break
+                    chunks.put(chunk)
+                # Don't glue the last line of a file to the next file.
+                if last and not last.endswith(b"\n"):
+                    chunks.put(b"\n")
+    except Exception as e:
+        chunks.put(e)
+    finally:
+        chunks.put(None)
+
+
+def input_lines(paths: List[str]) -> Iterator[str]:
+    """Iterates over the lines in each file in `paths`, like
+    fileinput.input(), but reads in a separate thread (see read_chunks).
+    Reads from stdin if `paths` is empty, or for "-"."""
+    chunks: "queue.Queue[Any]" = queue.Queue(maxsize=INPUT_QUEUE_CHUNKS)
+    threading.Thread(target=read_chunks, args=(paths, chunks), daemon=True).start()
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            break
+        if isinstance(chunk, Exception):
+            raise chunk
+        # The last element is an incomplete line (or empty).
+        lines = (pending + decoder.decode(chunk)).split("\n")
+        pending = lines.pop()
+        yield from lines
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+# Traces only have a handful of distinct comms, so remember whether
+# each one matches COMM_PATTERN.
+COMM_FILTER_CACHE: Dict[str, bool] = dict()
+
+
+def comm_is_tracked(comm: str) -> bool:
+    """Returns whether events from `comm` match COMM_PATTERN."""
+    tracked = COMM_FILTER_CACHE.get(comm)
+    if tracked is None:
+        assert COMM_PATTERN is not None
+        tracked = COMM_FILTER_CACHE[comm] = bool(COMM_PATTERN.match(comm))
+    return tracked
+
+
+def segment_trace(lines: Iterable[str]) -> Iterator[Event]:
     """Converts an iteratable of lines into an iterator of parsed Event
     tuples."""
     event = None
     stack = []
-    for line in filter(None, map(lambda line: line.rstrip(), lines)):
-        if event is None:  # we're looking for an event
-            event = parse_event(line)
-        else:
-            frame = parse_frame(line)
+    # Set when we're skipping the stack frames of a filtered out event.
+    skip_frames = False
+    parse = parse_field_event if FIELD_MODE else parse_event
+    # Frame lines dominate traces, so we classify lines with a substring
+    # check: only lines with EVENT_MARKER go to parse_event, and the rest
+    # never pay for a failed event match.
+    for line in filter(None, map(str.rstrip, lines)):
+        if event is not None:
+            frame = parse_frame(line) if EVENT_MARKER not in line else None
             if frame:
                 stack.append(frame)
-            else:
-                yield event._replace(stack=tuple(stack))
-                event = parse_event(line)
-                stack = []
+                continue
+            frames = tuple(stack)
+            stack_id = STACK_IDS.setdefault(frames, len(STACK_POOL))
+            if stack_id == len(STACK_POOL):
+                STACK_POOL.append(frames)
+            # Build the tuple directly: _replace() is about twice as slow.
+            yield Event(event.ts, event.comm, event.tid, event.call, stack_id)
+            stack = []
+        elif skip_frames and EVENT_MARKER not in line:
+            continue
+        event = parse(line)
+        skip_frames = False
+        # Filter on comm before we parse the event's call and stack.
+        if (
+            event is not None
+            and COMM_PATTERN is not None
+            and not comm_is_tracked(event.comm)
+        ):
+            observe_timestamp(event.ts)
+            event = None
+            skip_frames = True
 
 
 ## Middle end of the pipeline: parse event calls.
-CALL_HANDLER_TABLE = dict()
 
+# Keyed on the call up to its argument list (e.g.,
+# "sdt_libpoireau:malloc"), with (num_arg, tracked, handler_id, handler)
+# values.  A single lookup dispatches each call to the only handler
+# that could possibly match.
+CALL_HANDLER_TABLE: Dict[str, Tuple[int, bool, int, Callable[..., Any]]] = dict()
 
-def _make_pattern(name, num_arg):
-    pattern = r"^sdt_libpoireau:" + name + "[(]"
-    pattern += ", ".join(
-        [r"__probe_ip: \d+"] + [r"arg%i: (\d+)" % i for i in range(1, num_arg + 1)]
-    )
-    pattern += "[)]$"
-    return re.compile(pattern, flags=re.ASCII)
+# Probe names, indexed by handler_id.
+HANDLER_NAMES: List[str] = []
+
+
+def parse_args(argstr: str) -> List[int]:
+    """Expects an argument list like
+    '__probe_ip: 140369085100327, arg1: 363, arg2: 139997680238592, arg3: 68076'
+    and returns the list of integer values for arg1, arg2, etc.
+
+    Raises ValueError or IndexError on malformed argument lists.
+    """
+    args = []
+    for tok in argstr.split(", "):
+        if not tok.startswith("arg"):
+            continue
+        # int() also accepts signs, whitespace and underscores: only
+        # take the plain decimal values the argument patterns used to
+        # match.
+        value = tok.partition(": ")[2]
+        if not value or not DECIMAL_DIGITS.issuperset(value):
+            raise ValueError("Malformed argument %r" % tok)
+        args.append(int(value))
+    return args
 
 
-def call_handler(name, num_arg):
-    """Use this decorator to register a handler for probe call `name` with `num_arg` arguments."""
-    pattern = _make_pattern(name, num_arg)
+def call_handler(name, num_arg, tracked=False):
+    """Use this decorator to register a handler for probe call `name` with `num_arg` arguments.
 
-    def pattern_decorator(fun):
-        assert pattern not in CALL_HANDLER_TABLE
-        CALL_HANDLER_TABLE[pattern] = fun
+    Calls that are `tracked` update allocation records, so their
+    arguments must fit in AllocationTable's integer columns.
+    """
+
+    def handler_decorator(fun):
+        assert EVENT_MARKER + name not in CALL_HANDLER_TABLE
+        # The id lives in the table rather than on `fun`: functions
+        # compiled with mypyc do not accept attributes.
+        CALL_HANDLER_TABLE[EVENT_MARKER + name] = (
+            num_arg,
+            tracked,
+            len(HANDLER_NAMES),
+            fun,
+        )
+        HANDLER_NAMES.append(name)
         return fun
 
-    return pattern_decorator
+    return handler_decorator
 
 
 # mmap_failed: size, alignment, padded_size, errno
 @call_handler("mmap_failed", 4)
-def mmap_failed_handler(match, event):
-    print(
-        "Application failed to mmap %s bytes (%s aligned to %s); errno %s. Trace: %s."
-        % (match[3], match[1], match[2], match[4], event.stack),
-        file=sys.stderr,
+def mmap_failed_handler(args, event):
+    logger.warning(
+        "Application failed to mmap %s bytes (%s aligned to %s); errno %s. Trace: %s.",
+        args[2],
+        args[0],
+        args[1],
+        args[3],
+        STACK_POOL[event.stack],
     )
     return None
 
@@ -235,9 +683,9 @@ def mmap_failed_handler(match, event):
 FreeCall = namedtuple("FreeCall", ["old_id", "old_ptr", "old_size"])
 
 
-@call_handler("free", 3)
-def free_handler(match, event):
-    return FreeCall(int(match[1]), int(match[2]), int(match[3]))
+@call_handler("free", 3, tracked=True)
+def free_handler(args, event):
+    return FreeCall(*args)
 
 
 # realloc_from_tracked: old_id, old_ptr, old_size, new_id, new_ptr, new_size
@@ -247,16 +695,9 @@ ReallocTrackedCall = namedtuple(
 )
 
 
-@call_handler("realloc_from_tracked", 6)
-def realloc_tracked_handler(match, event):
-    return ReallocTrackedCall(
-        int(match[1]),
-        int(match[2]),
-        int(match[3]),
-        int(match[4]),
-        int(match[5]),
-        int(match[6]),
-    )
+@call_handler("realloc_from_tracked", 6, tracked=True)
+def realloc_tracked_handler(args, event):
+    return ReallocTrackedCall(*args)
 
 
 # realloc: old_ptr, old_size, new_id, new_ptr, new_size
@@ -265,11 +706,9 @@ ReallocUntrackedCall = namedtuple(
 )
 
 
-@call_handler("realloc", 5)
-def realloc_untracked_handler(match, event):
-    return ReallocUntrackedCall(
-        int(match[1]), int(match[2]), int(match[3]), int(match[4]), int(match[5])
-    )
+@call_handler("realloc", 5, tracked=True)
+def realloc_untracked_handler(args, event):
+    return ReallocUntrackedCall(*args)
 
 
 # realloc_to_regular: old_id, old_ptr, old_size, new_ptr, new_size
@@ -278,29 +717,28 @@ ReallocLoseCall = namedtuple(
 )
 
 
-@call_handler("realloc_to_regular", 5)
-def realloc_lose_handler(match, event):
-    return ReallocLoseCall(
-        int(match[1]), int(match[2]), int(match[3]), int(match[4]), int(match[5])
-    )
+@call_handler("realloc_to_regular", 5, tracked=True)
+def realloc_lose_handler(args, event):
+    return ReallocLoseCall(*args)
 
 
 # malloc: new_id, new_ptr, new_size
 MallocCall = namedtuple("MallocCall", ["new_id", "new_ptr", "new_size"])
 
 
-@call_handler("malloc", 3)
-def malloc_handler(match, event):
-    return MallocCall(int(match[1]), int(match[2]), int(match[3]))
+@call_handler("malloc", 3, tracked=True)
+def malloc_handler(args, event):
+    return MallocCall(*args)
 
 
 # calloc_overflow: num, size
 @call_handler("calloc_overflow", 2)
-def calloc_overflow_handler(match, event):
-    print(
-        "Application failed to calloc %s * %s Trace: %s."
-        % (match[1], match[2], event.stack),
-        file=sys.stderr,
+def calloc_overflow_handler(args, event):
+    logger.warning(
+        "Application failed to calloc %s * %s Trace: %s.",
+        args[0],
+        args[1],
+        STACK_POOL[event.stack],
     )
     return None
 
@@ -311,80 +749,310 @@ CallocCall = namedtuple(
 )
 
 
-@call_handler("calloc", 5)
-def calloc_handler(match, event):
-    return CallocCall(
-        int(match[1]), int(match[2]), int(match[3]), int(match[4]), int(match[5])
-    )
+@call_handler("calloc", 5, tracked=True)
+def calloc_handler(args, event):
+    return CallocCall(*args)
 
 
-def parse_event_calls(events):
-    event_type_count = defaultdict(int)
-    for i, event in enumerate(events, 1):
-        found = False
-        result = None
-        for pattern, handler in CALL_HANDLER_TABLE.items():
-            match = pattern.fullmatch(event.call)
-            if match:
-                call = handler(match, event)
-                if call is not None:
-                    result = call
-                    yield event._replace(call=call)
-                found = True
-                break
-        if found:
-            if result is not None:
-                event_type_count[type(result).__name__] += 1
-        else:
-            event_type_count["Unknown"] += 1
-            print("Unhandled call %s" % event.call, file=sys.stderr)
-        if LOG_ROW_PERIOD and (i == 1 or (i % LOG_ROW_PERIOD) == 0):
-            print(
-                "%s processed %i events %s"
-                % (datetime.utcnow().isoformat(), i, dict(event_type_count)),
-                file=sys.stderr,
-            )
+def find_call_handler(call: str) -> Optional[tuple]:
+    """Returns a tuple of the integer arguments, handler id and handler
+    for `call`, or None if there is no matching handler."""
+    name, _, argstr = call.partition("(")
+    entry = CALL_HANDLER_TABLE.get(name)
+    if entry is None or not argstr.endswith(")"):
+        return None
+    num_arg, tracked, handler_id, handler = entry
+    try:
+        args = parse_args(argstr[:-1])
+    except (IndexError, ValueError):
+        return None
+    if len(args) != num_arg:
+        return None
+    # Tracked calls store their arguments in AllocationTable, which
+    # reserves MISSING_INT; failure probes like calloc_overflow may
+    # legitimately report larger values.
+    if tracked and max(args) >= MISSING_INT:
+        return None
+    return args, handler_id, handler
+
+
+def format_event_type_count(event_type_count):
+    """Formats a list of counts by handler id, followed by the count of
+    unknown calls, as "name=count" pairs."""
+    return " ".join(
+        "%s=%i" % (name, count)
+        for name, count in zip(HANDLER_NAMES + ["Unknown"], event_type_count)
+        if count
+    )
 
 
 ## Model allocations and deallocations.  We were careful to name
 ## fields consistently: new_id/new_ptr/new_size for allocations,
 ## old_id/old_ptr/old_size for deallocations
 
-Allocation = namedtuple(
-    "Allocation",
+
+# An immutable copy of an Allocation's fields.
+AllocationSnapshot = namedtuple(
+    "AllocationSnapshot",
     [
         "ptr",
         "size",
         "first_ts",
-        "first_stack",
+        "first_stack_id",
         "last_ts",
-        "last_stack",
+        "last_stack_id",
         "free_ts",
-        "free_stack",
+        "free_stack_id",
     ],
 )
 
-EMPTY_ALLOCATION = Allocation(*([None] * 8))
+# Field names for Allocation.
+ALLOCATION_FIELDS = AllocationSnapshot._fields
+
+# Fields shown by Allocation.__repr__: the stacks as frames, not ids.
+ALLOCATION_REPR_FIELDS = tuple(
+    field[: -len("_id")] if field.endswith("_stack_id") else field
+    for field in ALLOCATION_FIELDS
+)
+
+# Stands for None in the integer columns of AllocationTable.
+MISSING_INT = (1 << 64) - 1
+
+# Stands for None in the timestamp columns of AllocationTable.
+MISSING_TS = -1.0
+
+# Stands for None in the stack id columns of AllocationTable.
+MISSING_STACK = (1 << 32) - 1
+
+
+def none_if_missing(value, missing):
+    """Returns None if `value` is the `missing` sentinel, else `value`."""
+    return None if value == missing else value
+
+
+class AllocationTable:
+    """Storage for the fields of Allocation records, one column per
+    field.  Fields live unboxed in arrays indexed by row, with stacks as
+    indices in STACK_POOL.  Rows of forgotten records are recycled."""
+
+    def __init__(self):
+        self.ptr = array("Q")
+        self.size = array("Q")
+        self.first_ts = array("d")
+        self.last_ts = array("d")
+        self.free_ts = array("d")
+        self.first_stack = array("I")
+        self.last_stack = array("I")
+        self.free_stack = array("I")
+        # Nonzero for records that reports skip, until they change.
+        self.ignored = bytearray()
+        self.free_rows = []
+
+    def add_row(self):
+        """Returns the index of a row with all fields missing."""
+        if self.free_rows:
+            return self.free_rows.pop()
+        for column in (self.ptr, self.size):
+            column.append(MISSING_INT)
+        for column in (self.first_ts, self.last_ts, self.free_ts):
+            column.append(MISSING_TS)
+        for column in (self.first_stack, self.last_stack, self.free_stack):
+            column.append(MISSING_STACK)
+        self.ignored.append(0)
+        return len(self.ptr) - 1
+
+    def release_row(self, row):
+        """Resets `row` to all missing fields, and queues it for reuse."""
+        for column in (self.ptr, self.size):
+            column[row] = MISSING_INT
+        for column in (self.first_ts, self.last_ts, self.free_ts):
+            column[row] = MISSING_TS
+        for column in (self.first_stack, self.last_stack, self.free_stack):
+            column[row] = MISSING_STACK
+        self.ignored[row] = 0
+        self.free_rows.append(row)
+
+    def state(self, row):
+        """Returns an AllocationSnapshot of the fields in `row`."""
+        return AllocationSnapshot(
+            none_if_missing(self.ptr[row], MISSING_INT),
+            none_if_missing(self.size[row], MISSING_INT),
+            none_if_missing(self.first_ts[row], MISSING_TS),
+            none_if_missing(self.first_stack[row], MISSING_STACK),
+            none_if_missing(self.last_ts[row], MISSING_TS),
+            none_if_missing(self.last_stack[row], MISSING_STACK),
+            none_if_missing(self.free_ts[row], MISSING_TS),
+            none_if_missing(self.free_stack[row], MISSING_STACK),
+        )
+
+
+ALLOCATION_TABLE = AllocationTable()
+
+
+class Allocation:
+    """A sampled allocation: a view of one row in ALLOCATION_TABLE.
+    observe_* functions update these records in place, and other
+    tables refer to the view object, so its identity is stable."""
+
+    __slots__ = ("row",)
+
+    @property
+    def ptr(self) -> Optional[int]:
+        value = ALLOCATION_TABLE.ptr[self.row]
+        return None if value == MISSING_INT else value
+
+    @ptr.setter
+    def ptr(self, value: Optional[int]) -> None:
+        ALLOCATION_TABLE.ptr[self.row] = MISSING_INT if value is None else value
+
+    @property
+    def size(self) -> Optional[int]:
+        value = ALLOCATION_TABLE.size[self.row]
+        return None if value == MISSING_INT else value
+
+    @size.setter
+    def size(self, value: Optional[int]) -> None:
+        ALLOCATION_TABLE.size[self.row] = MISSING_INT if value is None else value
+
+    @property
+    def first_ts(self) -> Optional[float]:
+        value = ALLOCATION_TABLE.first_ts[self.row]
+        return None if value == MISSING_TS else value
+
+    @first_ts.setter
+    def first_ts(self, value: Optional[float]) -> None:
+        ALLOCATION_TABLE.first_ts[self.row] = MISSING_TS if value is None else value
+
+    @property
+    def first_stack(self) -> Optional[Tuple[Frame, ...]]:
+        """The tuple of frames for first_stack_id."""
+        stack_id = ALLOCATION_TABLE.first_stack[self.row]
+        return None if stack_id == MISSING_STACK else STACK_POOL[stack_id]
+
+    @property
+    def first_stack_id(self) -> Optional[int]:
+        stack_id = ALLOCATION_TABLE.first_stack[self.row]
+        return None if stack_id == MISSING_STACK else stack_id
+
+    @first_stack_id.setter
+    def first_stack_id(self, value: Optional[int]) -> None:
+        ALLOCATION_TABLE.first_stack[self.row] = (
+            MISSING_STACK if value is None else value
+        )
+
+    @property
+    def last_ts(self) -> Optional[float]:
+        value = ALLOCATION_TABLE.last_ts[self.row]
+        return None if value == MISSING_TS else value
+
+    @last_ts.setter
+    def last_ts(self, value: Optional[float]) -> None:
+        ALLOCATION_TABLE.last_ts[self.row] = MISSING_TS if value is None else value
+
+    @property
+    def last_stack(self) -> Optional[Tuple[Frame, ...]]:
+        """The tuple of frames for last_stack_id."""
+        stack_id = ALLOCATION_TABLE.last_stack[self.row]
+        return None if stack_id == MISSING_STACK else STACK_POOL[stack_id]
+
+    @property
+    def last_stack_id(self) -> Optional[int]:
+        stack_id = ALLOCATION_TABLE.last_stack[self.row]
+        return None if stack_id == MISSING_STACK else stack_id
+
+    @last_stack_id.setter
+    def last_stack_id(self, value: Optional[int]) -> None:
+        ALLOCATION_TABLE.last_stack[self.row] = (
+            MISSING_STACK if value is None else value
+        )
+
+    @property
+    def free_ts(self) -> Optional[float]:
+        value = ALLOCATION_TABLE.free_ts[self.row]
+        return None if value == MISSING_TS else value
+
+    @free_ts.setter
+    def free_ts(self, value: Optional[float]) -> None:
+        ALLOCATION_TABLE.free_ts[self.row] = MISSING_TS if value is None else value
+
+    @property
+    def free_stack(self) -> Optional[Tuple[Frame, ...]]:
+        """The tuple of frames for free_stack_id."""
+        stack_id = ALLOCATION_TABLE.free_stack[self.row]
+        return None if stack_id == MISSING_STACK else STACK_POOL[stack_id]
+
+    @property
+    def free_stack_id(self) -> Optional[int]:
+        stack_id = ALLOCATION_TABLE.free_stack[self.row]
+        return None if stack_id == MISSING_STACK else stack_id
+
+    @free_stack_id.setter
+    def free_stack_id(self, value: Optional[int]) -> None:
+        ALLOCATION_TABLE.free_stack[self.row] = (
+            MISSING_STACK if value is None else value
+        )
+
+    # Released records may linger in ALLOCATIONS_AT_HIGH_WATER_MARK: they
+    # are never ignored, and their row belongs to someone else.
+    @property
+    def ignored(self) -> bool:
+        return self.row is not None and ALLOCATION_TABLE.ignored[self.row] != 0
+
+    @ignored.setter
+    def ignored(self, value: bool) -> None:
+        if self.row is not None:
+            ALLOCATION_TABLE.ignored[self.row] = value
+
+    def __init__(self):
+        self.row = ALLOCATION_TABLE.add_row()
+
+    def __repr__(self):
+        return "Allocation(%s)" % ", ".join(
+            "%s=%r" % (field, getattr(self, field)) for field in ALLOCATION_REPR_FIELDS
+        )
+
+    def state(self):
+        """Returns an AllocationSnapshot of the record's current fields."""
+        return ALLOCATION_TABLE.state(self.row)
+
+    def release(self):
+        """Returns the record's row to ALLOCATION_TABLE.  The record
+        must not be used afterwards."""
+        ALLOCATION_TABLE.release_row(self.row)
+        self.row = None
+
 
 # We map allocations to buckets by dividing by 1 GB.
 ALLOCATION_BUCKET_GRANULARITY = 1 << 30
 
-# Keyed on allocation_bucket.  We should eventually look use
-# tids and map to pids, but that's not necessary for now.
-ALLOCATIONS = dict()
+# Allocation records, keyed on allocation_bucket.  We should eventually
+# look use tids and map to pids, but that's not necessary for now.
+#
+# Each record lives in exactly one of these dicts, in insertion order:
+# live records (free_ts is None), or the most recently freed ones.
+# Reports only scan the one they need, and records of older frees are
+# forgotten.
+LIVE_ALLOCATIONS: Dict[int, Allocation] = dict()
+
+FREED_ALLOCATIONS: Dict[int, Allocation] = dict()
+
+# Only remember that many freed allocations, for the SIGUSR2 report
+# and to detect double frees.
+FREED_ALLOCATIONS_LIMIT = 100000
 
 # Updated with the max timestamp we ever observed
-LAST_EVENT = 0
+LAST_EVENT = 0.0
 
-# Estimate for the heap size in ALLOCATIONS
+# Estimate for the heap size in LIVE_ALLOCATIONS
 ESTIMATED_ALLOCATIONS_FOOTPRINT = 0
 
-# Max for the heap size in ALLOCATIONS
+# Max for the heap size in LIVE_ALLOCATIONS
 ALLOCATIONS_HIGH_WATER_MARK = 0
 
 # Updated with a list of live sampled allocations whenever we increase
-# ALLOCATIONS_HIGH_WATER_MARK.
-ALLOCATIONS_AT_HIGH_WATER_MARK = []
+# ALLOCATIONS_HIGH_WATER_MARK.  Each entry is a pair of the live
+# Allocation record and a snapshot of its state at the high water mark.
+ALLOCATIONS_AT_HIGH_WATER_MARK: List[Tuple[Allocation, AllocationSnapshot]] = []
 
 
 def estimate_allocation_size(alloc):
@@ -406,46 +1074,92 @@ def check_high_water_mark():
         return
     ALLOCATIONS_HIGH_WATER_MARK = ESTIMATED_ALLOCATIONS_FOOTPRINT
     ALLOCATIONS_AT_HIGH_WATER_MARK = [
-        record for record in ALLOCATIONS.values() if not record.free_ts
+        (record, record.state())
+        for record in LIVE_ALLOCATIONS.values()
+        if not record.free_ts
     ]
     if ALLOCATIONS_HIGH_WATER_MARK >= TRACK_HIGH_WATER_MARK_AFTER:
-        print_allocations_at_high_water_mark(True)
+        report = high_water_mark_report(True)
+        if report is not None:
+            REPORT_QUEUE.put(report)
 
 
-def assert_empty_bucket(key, alloc):
-    current = ALLOCATIONS.get(key, None)
+def assert_empty_bucket(key, event):
+    current = LIVE_ALLOCATIONS.get(key)
     # If we already have an allocation object that's not been freed
     # yet, something went really wrong.
-    if current is not None and current.free_ts is None:
-        print(
-            "Heap corruption: double allocating in the same bucket?! old: %s, new: %s."
-            % (current, alloc),
-            file=sys.stderr,
+    if current is not None:
+        logger.warning(
+            "Heap corruption: double allocating in the same bucket?! old: %s, new: %f %s.",
+            current,
+            event.ts,
+            STACK_POOL[event.stack],
         )
 
 
 def assert_present_bucket(key, event):
-    current = ALLOCATIONS.get(key, None)
+    current = FREED_ALLOCATIONS.get(key)
     # If there is no current entry, we probably just started tracing
     # too late to observe the allocation call.
-    if current is not None and current.free_ts is not None:
-        print(
-            "Double-free? de/re-allocating from an empty bucket?! old: %s, new: %f %s."
-            % (current, event.ts, event.stack)
+    if current is not None:
+        logger.warning(
+            "Double-free? de/re-allocating from an empty bucket?! old: %s, new: %f %s.",
+            current,
+            event.ts,
+            STACK_POOL[event.stack],
         )
 
 
+def get_allocation(key):
+    """Returns the Allocation record for `key`, after creating an
+    empty one if necessary.
+
+    Records are mutated in place, so any update also clears the record's
+    ignored flag: ignoring applies to a snapshot of the allocation, not
+    to whatever the bucket will contain later.
+    """
+    alloc = LIVE_ALLOCATIONS.get(key)
+    if alloc is None:
+        alloc = FREED_ALLOCATIONS.get(key)
+    if alloc is None:
+        # index_allocation files the new record once it's populated.
+        alloc = Allocation()
+    else:
+        alloc.ignored = False
+    return alloc
+
+
+def index_allocation(key, alloc):
+    """Files the record for `key` in LIVE_ALLOCATIONS or FREED_ALLOCATIONS,
+    after an update."""
+    if alloc.free_ts is None:
+        FREED_ALLOCATIONS.pop(key, None)
+        LIVE_ALLOCATIONS[key] = alloc
+        return
+    LIVE_ALLOCATIONS.pop(key, None)
+    # Re-insert to keep FREED_ALLOCATIONS sorted by recency.
+    FREED_ALLOCATIONS.pop(key, None)
+    FREED_ALLOCATIONS[key] = alloc
+    if len(FREED_ALLOCATIONS) > FREED_ALLOCATIONS_LIMIT:
+        # Allocation ids aren't reused, so there's nothing left to
+        # learn from the oldest freed record: forget it entirely, to
+        # keep our footprint flat over long sessions.
+        evicted = next(iter(FREED_ALLOCATIONS))
+        FREED_ALLOCATIONS.pop(evicted).release()
+
+
 def observe_alloc(event):
     global ESTIMATED_ALLOCATIONS_FOOTPRINT
     call = event.call
     key = call.new_id  # call.new_ptr // ALLOCATION_BUCKET_GRANULARITY
-    alloc = ALLOCATIONS.get(key, EMPTY_ALLOCATION)
-    alloc = alloc._replace(
-        ptr=call.new_ptr, size=call.new_size, first_ts=event.ts, first_stack=event.stack
-    )
-    assert_empty_bucket(key, alloc)
-    ALLOCATIONS[key] = alloc
+    assert_empty_bucket(key, event)
+    alloc = get_allocation(key)
+    alloc.ptr = call.new_ptr
+    alloc.size = call.new_size
+    alloc.first_ts = event.ts
+    alloc.first_stack_id = event.stack
     ESTIMATED_ALLOCATIONS_FOOTPRINT += estimate_allocation_size(alloc)
+    index_allocation(key, alloc)
     check_high_water_mark()
 
 
@@ -454,9 +1168,11 @@ def observe_free(event):
     call = event.call
     key = call.old_id  # call.old_ptr // ALLOCATION_BUCKET_GRANULARITY
     assert_present_bucket(key, event)
-    current = ALLOCATIONS.get(key, EMPTY_ALLOCATION)
-    ALLOCATIONS[key] = current._replace(free_ts=event.ts, free_stack=event.stack)
-    ESTIMATED_ALLOCATIONS_FOOTPRINT -= estimate_allocation_size(current)
+    alloc = get_allocation(key)
+    alloc.free_ts = event.ts
+    alloc.free_stack_id = event.stack
+    ESTIMATED_ALLOCATIONS_FOOTPRINT -= estimate_allocation_size(alloc)
+    index_allocation(key, alloc)
     check_high_water_mark()
 
 
@@ -467,52 +1183,144 @@ def observe_realloc(event):
     assert key == call.new_id  # call.new_ptr // ALLOCATION_BUCKET_GRANULARITY
 
     assert_present_bucket(key, event)
-    current = ALLOCATIONS.get(key, EMPTY_ALLOCATION)
-    new = current._replace(
-        ptr=call.new_ptr, size=call.new_size, last_ts=event.ts, last_stack=event.stack,
-    )
-    ALLOCATIONS[key] = new
-    ESTIMATED_ALLOCATIONS_FOOTPRINT -= estimate_allocation_size(current)
-    ESTIMATED_ALLOCATIONS_FOOTPRINT += estimate_allocation_size(new)
+    alloc = get_allocation(key)
+    ESTIMATED_ALLOCATIONS_FOOTPRINT -= estimate_allocation_size(alloc)
+    alloc.ptr = call.new_ptr
+    alloc.size = call.new_size
+    alloc.last_ts = event.ts
+    alloc.last_stack_id = event.stack
+    ESTIMATED_ALLOCATIONS_FOOTPRINT += estimate_allocation_size(alloc)
+    index_allocation(key, alloc)
     check_high_water_mark()
 
 
-def observe_events(events):
+def observe_timestamp(ts):
     global LAST_EVENT
-    for event in events:
-        LAST_EVENT = max(LAST_EVENT, event.ts)
-        if not re.match(COMM_PATTERN, event.comm):
-            continue
+    LAST_EVENT = max(LAST_EVENT, ts)
+
+
+def observe_tracked_realloc(event):
+    """A tracked realloc that keeps its id updates the allocation in
+    place; otherwise, it frees the old id and allocates the new one."""
+    if event.call.old_id == event.call.new_id:
+        observe_realloc(event)
+    else:
+        observe_free(event)
+        observe_alloc(event)
+
+
+# Maps each type of call tuple to its observer: calls with a new_id
+# allocate, calls with an old_id free.
+CALL_OBSERVER_TABLE = {
+    MallocCall: observe_alloc,
+    CallocCall: observe_alloc,
+    ReallocUntrackedCall: observe_alloc,
+    FreeCall: observe_free,
+    ReallocLoseCall: observe_free,
+    ReallocTrackedCall: observe_tracked_realloc,
+}
+
+
+def observe_events(events: Iterable[Event]) -> None:
+    """Parses the call in each event from segment_trace, and observes its
+    effect on allocation records.
+
+    Parsing calls and observing them happen in the same loop, so events
+    only cross one generator boundary on their way from the input.
+    """
+    # Indexed by handler id, with a final slot for unknown calls.
+    event_type_count = [0] * (len(HANDLER_NAMES) + 1)
+    find_handler = find_call_handler
+    observers = CALL_OBSERVER_TABLE
+    next_log = 0.0
+    for i, event in enumerate(events, 1):
+        match_handler = find_handler(event.call)
+        if match_handler is None:
+            event_type_count[-1] += 1
+            logger.warning("Unhandled call %s", event.call)
+        else:
+            args, handler_id, handler = match_handler
+            event_type_count[handler_id] += 1
+            call = handler(args, event)
+            if call is not None:
+                observe_timestamp(event.ts)
+                observer = observers.get(type(call))
+                if observer is not None:
+                    observer(Event(event.ts, event.comm, event.tid, call, event.stack))
         if (
-            hasattr(event.call, "old_id")
-            and hasattr(event.call, "new_id")
-            and event.call.old_id == event.call.new_id
+            LOG_PERIOD is not None
+            and (i == 1 or (i % LOG_ROW_PERIOD) == 0)
+            and logger.isEnabledFor(logging.INFO)
         ):
-            observe_realloc(event)
-        else:
-            if hasattr(event.call, "old_id"):
-                observe_free(event)
-            if hasattr(event.call, "new_id"):
-                observe_alloc(event)
+            now = time.monotonic()
+            if now >= next_log:
+                next_log = now + LOG_PERIOD
+                logger.info(
+                    "%s processed %i events %s",
+                    datetime.utcnow().isoformat(),
+                    i,
+                    format_event_type_count(event_type_count),
+                )
 
 
 ## Print live allocations that were last touched 1s after the last event
-def format_stack(stack):
+
+# Formatted strings for STACK_POOL entries, keyed on stack id.  Periodic
+# reports print the same long-lived allocations over and over, so only
+# format each stack once.  The pool itself bounds the cache's size.
+FORMAT_CACHE: Dict[int, str] = dict()
+
+ADDRESS_DIGITS = frozenset("0123456789abcdefABCDEF")
+
+
+def symbol_is_address(symbol):
+    """Returns whether `symbol` is a bare decimal or 0x-prefixed hex
+    address, optionally in brackets."""
+    if symbol[:1] == "[":
+        symbol = symbol[1:]
+    if symbol[-1:] == "]":
+        symbol = symbol[:-1]
+    if symbol[:2] == "0x":
+        return len(symbol) > 2 and ADDRESS_DIGITS.issuperset(symbol[2:])
+    return symbol != "" and DECIMAL_DIGITS.issuperset(symbol)
+
+
+def format_stack(stack_id):
+    """Returns the semicolon-separated symbols for STACK_POOL[stack_id]."""
+
     def format_frame(frame):
         # If the symbol is just an address, print the dso.
-        if re.fullmatch(r"\[?(0x[0-9a-fA-F]+)|[0-9]+\]?", frame.symbol):
+        if symbol_is_address(frame.symbol):
             return "[%s]" % frame.dso
         return frame.symbol
 
-    return ";".join(map(format_frame, stack))
+    formatted = FORMAT_CACHE.get(stack_id)
+    if formatted is None:
+        formatted = ";".join(map(format_frame, STACK_POOL[stack_id]))
+        FORMAT_CACHE[stack_id] = formatted
+    return formatted
 
 
 def print_alloc(alloc, now):
     """Prints a live allocation."""
-    if alloc.last_ts is None:
+    if alloc.first_ts is None:
+        # First seen through a realloc: we missed the allocation call.
+        print(
+            "\tsize=%i m_age=%f realloc=%s"
+            % (
+                alloc.size,
+                now - alloc.last_ts,
+                format_stack(alloc.last_stack_id),
+            )
+        )
+    elif alloc.last_ts is None:
         print(
             "\tsize=%i c_age=%f alloc=%s"
-            % (alloc.size, now - alloc.first_ts, format_stack(alloc.first_stack))
+            % (
+                alloc.size,
+                now - alloc.first_ts,
+                format_stack(alloc.first_stack_id),
+            )
         )
     else:
         print(
@@ -520,9 +1328,9 @@ def print_alloc(alloc, now):
             % (
                 alloc.size,
                 now - alloc.first_ts,
-                format_stack(alloc.first_stack),
+                format_stack(alloc.first_stack_id),
                 now - alloc.last_ts,
-                format_stack(alloc.last_stack),
+                format_stack(alloc.last_stack_id),
             )
         )
 
@@ -537,8 +1345,8 @@ def print_dalloc(alloc):
                 alloc.ptr,
                 alloc.size,
                 alloc.free_ts,
-                format_stack(alloc.free_stack),
-                format_stack(alloc.first_stack),
+                format_stack(alloc.free_stack_id),
+                format_stack(alloc.first_stack_id),
                 alloc.first_ts,
             )
         )
@@ -549,95 +1357,115 @@ def print_dalloc(alloc):
                 alloc.ptr,
                 alloc.size,
                 alloc.free_ts,
-                format_stack(alloc.free_stack),
-                format_stack(alloc.first_stack),
-                format_stack(alloc.last_stack),
+                format_stack(alloc.free_stack_id),
+                format_stack(alloc.first_stack_id),
+                format_stack(alloc.last_stack_id),
                 alloc.first_ts,
                 alloc.last_ts,
             )
         )
 
 
-IGNORED_ALLOCS = set()
-
+def print_report_overflow(count):
+    """Notes how many of `count` reportable allocations we didn't print."""
+    if count > REPORT_LIMIT:
+        print(
+            "\t... and %i more (POIREAU_REPORT_LIMIT=%i)"
+            % (count - REPORT_LIMIT, REPORT_LIMIT)
+        )
 
-def print_allocations_at_high_water_mark(new_record):
-    """Prints allocations in `allocs`, which should represent a set of
-    allocations with a large aggregate footprint.
 
-    Ignores any allocation that's already in IGNORED_ALLOCS; populates
-    that set with all current allocations if mark_ignored is True.
+def high_water_mark_report(new_record):
+    """Returns a report of the allocations at the high water mark, for
+    print_queued_reports, or None if there is nothing to report.
 
+    The report only reads values computed now, so another thread can
+    print it while this one keeps updating allocation records.  Ignores
+    any allocation that's been flagged as ignored since, and hasn't
+    changed.
     """
     if not TRACK_HIGH_WATER_MARK or not ALLOCATIONS_AT_HIGH_WATER_MARK:
-        return
+        return None
+    now = time.monotonic() if RECORDS_MATCH_REAL_TIME else LAST_EVENT
+    # Only skip allocations that were ignored in the same state.
+    snapshots = [
+        snapshot
+        for alloc, snapshot in ALLOCATIONS_AT_HIGH_WATER_MARK
+        if not alloc.ignored or alloc.state() != snapshot
+    ]
+    return functools.partial(
+        print_allocations_at_high_water_mark,
+        snapshots,
+        ALLOCATIONS_HIGH_WATER_MARK,
+        now,
+        new_record,
+    )
+
+
+def print_allocations_at_high_water_mark(snapshots, mark, now, new_record):
+    """Prints `snapshots`, which should represent a set of allocations
+    with a large aggregate footprint of `mark` bytes, as of `now`.
+    """
     if RECORDS_MATCH_REAL_TIME:
-        now = time.monotonic()
         print(
             "%s allocations at %s high water mark %f MB"
             % (
                 datetime.utcnow().isoformat(),
                 "new" if new_record else "current",
-                ALLOCATIONS_HIGH_WATER_MARK / (1 << 20),
+                mark / (1 << 20),
             )
         )
     else:
-        now = LAST_EVENT
         print(
             "allocations at %s high water mark %f MB"
-            % (
-                "new" if new_record else "current",
-                ALLOCATIONS_HIGH_WATER_MARK / (1 << 20),
-            )
+            % ("new" if new_record else "current", mark / (1 << 20))
         )
 
     # Print large allocations first.
-    for alloc in sorted(
-        ALLOCATIONS_AT_HIGH_WATER_MARK, key=lambda x: x.size, reverse=True
-    ):
-        if alloc.free_ts is None and alloc not in IGNORED_ALLOCS:
-            print_alloc(alloc, now)
+    for snapshot in heapq.nlargest(REPORT_LIMIT, snapshots, key=lambda x: x.size):
+        print_alloc(snapshot, now)
+    print_report_overflow(len(snapshots))
 
 
-def print_old_allocs(allocs, max_age, max_stale=None, mark_ignored=False):
-    """Prints allocations older than max_age.
+def print_old_allocs(records, max_age, max_stale=None, limit=REPORT_LIMIT):
+    """Prints allocations older than max_age.  `records` are
+    (AllocationSnapshot, ignored) pairs, see snapshot_allocations.
 
     If max_stale is provided, it ignores allocations that were
     reallocated more recently than max_stale.
 
-    Ignores any allocation that's already in IGNORED_ALLOCS; populates
-    that set with all current allocations if mark_ignored is True.
+    Skips any allocation that was flagged as ignored.  Allocations
+    first seen through a realloc are aged from that realloc.
+
+    Prints at most `limit` allocations, or all of them if limit is None.
     """
-    global IGNORED_ALLOCS
-
-    # We assume Allocation tuples do not come back in the list of
-    # allocs; once it's disappeared from the list, we can drop it from
-    # the ignored list.
-    #
-    # This set includes all Allocation tuples that should be ignored
-    # and are still present in the list of allocs.
-    seen_ignored = set()
+    printed = 0
     if RECORDS_MATCH_REAL_TIME:
         now = time.monotonic()
         print("%s old allocations" % datetime.utcnow().isoformat())
     else:
         now = LAST_EVENT
 
-    for alloc in allocs:
-        if alloc in IGNORED_ALLOCS or mark_ignored:
-            seen_ignored.add(alloc)
+    for state, ignored in records:
         # It's been freed, clearly not a leak.
-        if alloc.free_ts is not None:
+        if state.free_ts is not None:
             continue
-        age = now - alloc.first_ts
-        stale = now - alloc.last_ts if alloc.last_ts is not None else None
+        if state.first_ts is not None:
+            age = now - state.first_ts
+        else:
+            age = now - state.last_ts
+        stale = now - state.last_ts if state.last_ts is not None else None
         # Don't print if it's been recently reallocated
         if stale and max_stale and stale <= max_stale:
             continue
-        # If it's old and not ignored, print it.
-        if age > max_age and alloc not in IGNORED_ALLOCS:
-            print_alloc(alloc, now)
-    IGNORED_ALLOCS = seen_ignored
+        # If it's old and not ignored, print it.  `records` come in
+        # allocation order, so we print the oldest ones first.
+        if age > max_age and not ignored:
+            if limit is None or printed < limit:
+                print_alloc(state, now)
+            printed += 1
+    if limit is not None:
+        print_report_overflow(printed)
 
 
 def print_frees(allocs):
@@ -663,43 +1491,134 @@ REPORT_PERIOD = 10 * 60
 INITIAL_REPORT_DELAY = 30
 
 
+# Serialises report output between the main thread and the reporter
+# thread.  Reentrant, because a signal handler may interrupt a report
+# on the main thread.
+REPORT_LOCK = threading.RLock()
+
+# Reports for print_queued_reports, as callables that only read
+# snapshots; None stops the reporter thread.
+REPORT_QUEUE: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+
+
+def print_queued_reports(reports: "queue.SimpleQueue[Any]") -> None:
+    """Calls each report from `reports`, until None.
+
+    Runs in a reporter thread, so that periodic and high water mark
+    reports don't stall ingestion (and let perf overflow the input
+    pipe) on large heaps.  Reports only read snapshots, so the main
+    thread remains free to update and recycle allocation records.
+    """
+    while True:
+        report = reports.get()
+        if report is None:
+            break
+        with REPORT_LOCK:
+            report()
+            sys.stdout.flush()
+
+
+def old_allocations(max_age):
+    """Yields live allocations first observed more than max_age ago.
+
+    LIVE_ALLOCATIONS is in allocation order, so it's also sorted by
+    first_ts, up to perf's reordering of events across CPUs: stop at the
+    first recent record instead of scanning the rest.  Records that
+    perf reordered right around the cutoff wait for the next report.
+
+    Records first seen through a realloc have no first_ts: like
+    print_old_allocs, we age them from that realloc.  Their position
+    doesn't change when they're reallocated again, so they can't stop
+    the scan.
+    """
+    if RECORDS_MATCH_REAL_TIME:
+        cutoff = time.monotonic() - max_age
+    else:
+        cutoff = LAST_EVENT - max_age
+    for alloc in LIVE_ALLOCATIONS.values():
+        first_ts = alloc.first_ts
+        if first_ts is None:
+            if alloc.last_ts < cutoff:
+                yield alloc
+        elif first_ts >= cutoff:
+            break
+        else:
+            yield alloc
+
+
+def snapshot_allocations(allocs):
+    """Yields (AllocationSnapshot, ignored) pairs for the Allocation
+    records in `allocs`, for print_old_allocs.
+
+    There's no need to clear stale ignored flags: get_allocation clears
+    a record's flag as soon as it changes, and freeing is a change.
+    That's also why reports don't have to list every allocation.
+    """
+    for alloc in allocs:
+        yield alloc.state(), alloc.ignored
+
+
 def hup_handler(signum=None, frame=None):
     """On SIGHUP, print all current allocations."""
-    print_old_allocs(ALLOCATIONS.values(), 0, max_stale=0)
-    print_allocations_at_high_water_mark(False)
+    with REPORT_LOCK:
+        print_old_allocs(
+            snapshot_allocations(LIVE_ALLOCATIONS.values()),
+            0,
+            max_stale=0,
+            limit=None,
+        )
+        report = high_water_mark_report(False)
+        if report is not None:
+            report()
 
 
 def usr1_handler(signum=None, frame=None):
     """On SIGUSR1, print old allocations, and add everything to the ignored set."""
-    print_old_allocs(
-        ALLOCATIONS.values(),
-        SUSPECT_ALLOCATION_AGE,
-        max_stale=SUSPECT_ALLOCATION_STALE,
-        mark_ignored=True,
-    )
-    print(
-        "%s currently extant allocations now ignored." % datetime.utcnow().isoformat()
-    )
+    with REPORT_LOCK:
+        print_old_allocs(
+            snapshot_allocations(LIVE_ALLOCATIONS.values()),
+            SUSPECT_ALLOCATION_AGE,
+            max_stale=SUSPECT_ALLOCATION_STALE,
+        )
+        for alloc in LIVE_ALLOCATIONS.values():
+            alloc.ignored = True
+        print(
+            "%s currently extant allocations now ignored."
+            % datetime.utcnow().isoformat()
+        )
 
 
 def usr2_handler(signum=None, frame=None):
     """On SIGUSR2, print freed allocations."""
-    print_frees(ALLOCATIONS.values())
+    with REPORT_LOCK:
+        print_frees(FREED_ALLOCATIONS.values())
 
 
 def alrm_handler(signum=None, frame=None):
-    """Regulary print current old allocations"""
-    print_old_allocs(
-        ALLOCATIONS.values(), SUSPECT_ALLOCATION_AGE, max_stale=SUSPECT_ALLOCATION_STALE
+    """Regularly queue a snapshot of old allocations for the reporter
+    thread to print."""
+    # Only copy the records that the report may print.
+    REPORT_QUEUE.put(
+        functools.partial(
+            print_old_allocs,
+            list(snapshot_allocations(old_allocations(SUSPECT_ALLOCATION_AGE))),
+            SUSPECT_ALLOCATION_AGE,
+            max_stale=SUSPECT_ALLOCATION_STALE,
+        )
     )
     signal.alarm(REPORT_PERIOD)
 
 
-if __name__ == "__main__":
+def main():
+    logging.basicConfig(format="%(message)s", level=LOG_LEVEL)
     signal.signal(signal.SIGALRM, alrm_handler)
     signal.signal(signal.SIGHUP, hup_handler)
     signal.signal(signal.SIGUSR1, usr1_handler)
     signal.signal(signal.SIGUSR2, usr2_handler)
+    reporter = threading.Thread(
+        target=print_queued_reports, args=(REPORT_QUEUE,), daemon=True
+    )
+    reporter.start()
 
     # There's no point sending out regular reports if they're not in
     # real time.
@@ -708,8 +1627,15 @@ if __name__ == "__main__":
         # allocation could be considered old enough to be suspect.
         signal.alarm(SUSPECT_ALLOCATION_AGE + INITIAL_REPORT_DELAY)
     try:
-        observe_events(parse_event_calls(segment_trace(fileinput.input())))
+        observe_events(segment_trace(input_lines(sys.argv[1:])))
     except KeyboardInterrupt:
         pass
+    # Let any pending report finish before the final one.
+    REPORT_QUEUE.put(None)
+    reporter.join()
     hup_handler()
     sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()